@@ -11,8 +11,11 @@ from dateutil.relativedelta import relativedelta
 from sklearn.model_selection import train_test_split
 
 from addpath import data_path, configfile_path
-from algorithm.future_downloading import get_hisBar
-from algorithm.stock_downloading import getIndexComponents, getInnercode, getAShrData, getAdjFactor
+from algorithm.future_downloading import get_hisBar_columns
+from algorithm.deadline import stage_start, stage_remaining, request_timeout, call_with_timeout, cached_data, \
+    record_degradation
+from algorithm.payload_decoding import stamps_to_datetime64, slice_columns
+from algorithm.stock_downloading import getIndexTickers, getInnercodeColumns, getAShrColumns, getAdjFactor
 
 # load the configurations
 config = configparser.ConfigParser()
@@ -35,27 +38,42 @@ def date_identification(input_date_str):
     return input_date_df
 
 
-def data_downloading_fully(input_date_df):
+def data_downloading_fully(input_date_df, deadline=None):
     """
         Download all the future price and stock price from one year ago to the given date.
         The return of this function will be a tuple containing three data frames: (futures, close, adj_df).
         Raw close price for stocks, close price for future, adjustment factor, and adjusted price will be saved
     in data_path.
+        If deadline (from deadline.deadline_setup) is given, each stage runs within its time budget: a request that
+    fails or misses its timeout is replaced by the values cached by the latest earlier run, and the stocks without
+    cached values are dropped. Every degradation is recorded in deadline for the report, with the date of the last
+    real observation of the cached values. Cached values are saved again as they are, without being carried forward
+    to the input date, so that a later run sees how stale they are.
     """
     # download future data
     print('---- Start downloading future price data.')
     tmp_time1 = timer()
+    stage_start(deadline, 'future')
     input_date_str = str(input_date_df.input_date.squeeze().date())
     # load the code for future
     future_code = config['parameters']['future_code']
     futures_start_date = str(input_date_df.start_date.squeeze().date())
     futures_end_date = str(input_date_df.end_date.squeeze().date())
-    future_data = get_hisBar(symbol=future_code, exchange='CFFEX', freq='1d', start=futures_start_date,
-                             end=futures_end_date)
-    futures = future_data[['time', 'close']]
-    futures.rename(columns={'time': 'times'}, inplace=True)
-    futures['times'] = (futures['times'] / 10e5).apply(int).apply(lambda x: pd.to_datetime(str(x), format='%Y%m%d'))
-    futures = futures.set_index('times')
+    future_data, status = call_with_timeout(deadline, get_hisBar_columns, symbol=future_code, exchange='CFFEX',
+                                            freq='1d', start=futures_start_date, end=futures_end_date,
+                                            timeout=request_timeout(deadline))
+    if status == 'ok' and future_data is not None:
+        # the payload is decoded into typed columns, and the time stamps are truncated to dates in a vectorized way
+        futures_times = pd.DatetimeIndex(stamps_to_datetime64(future_data['time'], date_only=True), name='times')
+        futures = pd.DataFrame({'close': future_data['close']}, index=futures_times)
+    else:
+        futures, cache_date = cached_data('futures.csv', input_date_str)
+        if deadline is None or futures is None or futures.empty:
+            print('---- Failed to download the future price data, and no cached data is available.')
+            sys.exit()
+        cache_date = str(futures.index[-1].date())  # the last real observation
+        record_degradation(deadline, future_code, 'cached', 'request %s' % status, cache_date)
+        print('---- Future price data cached on %s will be used.' % cache_date)
     futures.to_csv(join(data_path, input_date_str, 'futures.csv'))
     tmp_time2 = timer()
     print('---- Finish downloading future price data. Time consumed: %.3fs.' % (tmp_time2 - tmp_time1))
@@ -63,20 +81,42 @@ def data_downloading_fully(input_date_df):
     # load the stock pool and trading dates.
     print('---- Start loading the stock pool information.')
     tmp_time1 = timer()
+    stage_start(deadline, 'components')
     # load the stock pool indicator
     stock_pool = config['parameters']['stock_pool']
     if stock_pool in ['000300.SH', '000905.SH']:
         component_start_date = input_date_df.start_date.squeeze().date()
-        IndexComponents = getIndexComponents(stock_pool, str(component_start_date), futures_end_date)
-        while IndexComponents.size == 0:
-            print('---- No recent index components data available. Earlier components will be introduced.')
-            component_start_date = component_start_date + relativedelta(months=-6)
-            IndexComponents = getIndexComponents(stock_pool, str(component_start_date), futures_end_date)
-            if IndexComponents.size > 0:
+        IndexTickers, status = call_with_timeout(deadline, getIndexTickers, stock_pool, str(component_start_date),
+                                                 futures_end_date, timeout=request_timeout(deadline) or 600)
+        retried, widened = False, False
+        # only an empty response widens the window; a request that fails or times out is retried once on the same
+        # window before the cache is used. in the deadline mode, the search stops once the stage budget is used up
+        while not (status == 'ok' and IndexTickers.size > 0) and (deadline is None or stage_remaining(deadline) > 0):
+            if status == 'ok':
+                print('---- No recent index components data available. Earlier components will be introduced.')
+                component_start_date = component_start_date + relativedelta(months=-6)
+                widened = True
+            elif not retried:
+                print('---- Request for the index components %s. Retrying.' % status)
+                retried = True
+            else:
+                break
+            IndexTickers, status = call_with_timeout(deadline, getIndexTickers, stock_pool, str(component_start_date),
+                                                     futures_end_date, timeout=request_timeout(deadline) or 600)
+            if status == 'ok' and IndexTickers.size > 0 and widened:
                 print('---- Components starting from %s introduced.' % str(component_start_date))
-        stk_list = IndexComponents['ticker'].to_list()
-        stk_list = list(set(stk_list))#[:10]
-        del IndexComponents
+        if not (status == 'ok' and IndexTickers.size > 0):
+            # the stock pool of the latest run is reused
+            cached_close, cache_date = cached_data('close.csv', input_date_str)
+            if cached_close is None:
+                print('---- Failed to load the stock pool information, and no cached data is available.')
+                sys.exit()
+            IndexTickers = cached_close.columns.to_numpy()
+            record_degradation(deadline, stock_pool, 'cached',
+                               'request %s' % status if status != 'ok' else 'stage budget used up', cache_date)
+            print('---- Stock pool cached on %s will be used.' % cache_date)
+        stk_list = IndexTickers.tolist()#[:10]
+        del IndexTickers
     else:
         print(
             '---- The stock pool specified in the configuration file is improper. Please choose between \"000300.SH\" and \"000905.SH\".')
@@ -88,7 +128,18 @@ def data_downloading_fully(input_date_df):
     # download stock prices and adjustment factors, and then do dividend adjustment
     print('---- Start downloading stock prices.')
     tmp_time1 = timer()
-    Innercode = getInnercode()
+    stage_start(deadline, 'stocks')
+    Innercode, status = call_with_timeout(deadline, getInnercodeColumns, timeout=request_timeout(deadline))
+    if status != 'ok':
+        # without the inner codes no stock can be downloaded, so the request is retried once
+        Innercode, status = call_with_timeout(deadline, getInnercodeColumns, timeout=request_timeout(deadline))
+    if status == 'ok':
+        pd.Series(Innercode, name='InnerCode').to_csv(join(data_path, input_date_str, 'innercode.csv'))
+    else:
+        cached_innercode, cache_date = cached_data('innercode.csv', input_date_str, parse_dates=False)
+        Innercode = {} if cached_innercode is None else cached_innercode['InnerCode'].to_dict()
+        record_degradation(deadline, 'InnerCode', 'cached' if Innercode else 'dropped', 'request %s' % status,
+                           cache_date)
     close_dict = {}
     adj_dict = {}
     startdate = input_date_df.start_date.squeeze().date()  # download from this day
@@ -97,26 +148,60 @@ def data_downloading_fully(input_date_df):
     enddate_adj_fac = input_date_df.end_date.squeeze().date()
     # download until this day (included). will be used for downloading adjustment factors
     count = (enddate - startdate).days  # count the number of days to download
+    slice_enddate = enddate  # the last day to keep after downloading (included)
     enddate = enddate.strftime('%Y%m%d000000')
     ktype = 5
 
-    for stk in stk_list:
+    # in the deadline mode, the prices and adjustment factors of the latest run replace the missing downloads
+    cached_stocks = {}
+    stale_list = []
+
+    def fall_back(stk, reason):
+        if not cached_stocks:
+            cached_stocks['close'], cached_stocks['close_date'] = cached_data('close.csv', input_date_str)
+            cached_stocks['adj'], cached_stocks['adj_date'] = cached_data('adj_fac.csv', input_date_str)
+        cached_close, cached_adj = cached_stocks['close'], cached_stocks['adj']
+        if cached_close is None or cached_adj is None or stk not in cached_close or stk not in cached_adj \
+                or cached_close[stk].last_valid_index() is None:
+            record_degradation(deadline, stk, 'dropped', reason + ', no cached data')
+            return
+        window = slice(pd.Timestamp(startdate), pd.Timestamp(slice_enddate))
+        close_dict[stk] = cached_close[stk].loc[window].rename_axis('times')
+        adj_dict[stk] = cached_adj[[stk]].loc[window].rename(columns={stk: 'adj_factor'})
+        stale_list.append(stk)
+        # the values are as stale as their last real observation, which can be older than the cache itself
+        record_degradation(deadline, stk, 'cached', reason, str(cached_close[stk].last_valid_index().date()))
+
+    for loc, stk in enumerate(stk_list):
         # download for stock prices
-        loc = stk_list.index(stk)
         if loc % 10 == 0:
             print('Working on stock No. %d: %s' % (loc + 1, stk))
 
-        stock = stk
-        innercode = int(Innercode.loc[Innercode["TradingCode"] == stock, "InnerCode"])
-        AShrData = getAShrData(innercode, ktype, enddate, count, adj=False)
-        AShrData['times'] = pd.to_datetime(AShrData['times'])
-        AShrData = AShrData.set_index('times')
-        AShrData = AShrData.reindex(index=AShrData.index[::-1])
-        AShrData = AShrData.loc[startdate:enddate, ]
-        close_dict[stk] = AShrData['nowv'].astype('int64') / 100
-
+        if deadline is not None:
+            if stage_remaining(deadline) <= 0:
+                fall_back(stk, 'stage budget used up')
+                continue
+            if stk not in Innercode:
+                fall_back(stk, 'no inner code')
+                continue
+
+        innercode = Innercode[stk]
+        # the payload is decoded into sorted typed columns, prices already converted from cents
+        AShrData, status = call_with_timeout(deadline, getAShrColumns, innercode, ktype, enddate, count, adj=False,
+                                             timeout=request_timeout(deadline))
         # download for adjustment factors
-        adj_dict[stk] = getAdjFactor(stk, startdate, enddate_adj_fac)
+        adj_factor, adj_status = call_with_timeout(deadline, getAdjFactor, stk, startdate, enddate_adj_fac)
+        if status != 'ok' or adj_status != 'ok':
+            fall_back(stk, 'request %s' % (status if status != 'ok' else adj_status))
+            continue
+
+        AShrData = slice_columns(AShrData, 'times', startdate, slice_enddate)
+        close_dict[stk] = pd.Series(AShrData['nowv'], index=pd.DatetimeIndex(AShrData['times'], name='times'))
+        adj_dict[stk] = adj_factor
+
+    if not close_dict:
+        print('---- Failed to download any stock price, and no cached data is available.')
+        sys.exit()
 
     # reorganize the dictionaries and convert them into dataframes. forward fill used
     close = pd.concat(close_dict, axis=1, join='outer')
@@ -124,10 +209,22 @@ def data_downloading_fully(input_date_df):
     adj_df.columns = close.columns
 
     # drop the columns with too many Nan values
-    close = close.dropna(axis=1, thresh=0.7 * close.shape[0]).ffill()
-    close.to_csv(join(data_path, input_date_str, 'close.csv'))
+    close = close.dropna(axis=1, thresh=0.7 * close.shape[0])
+    # a stock loaded from the cache and dropped here is reported as dropped only, its cached record is replaced
+    for stk in close_dict:
+        if stk not in close.columns:
+            record_degradation(deadline, stk, 'dropped', 'less than 70%% of the %s prices available'
+                               % ('cached' if stk in stale_list else 'downloaded'))
+    # cached prices end before the input date. they are saved without being carried forward, not to look fresh
+    stale_list = [stk for stk in stale_list if stk in close.columns]
+    close_cache = close.ffill()
+    close_cache[stale_list] = close[stale_list]
+    close_cache.to_csv(join(data_path, input_date_str, 'close.csv'))
+    close = close.ffill()
     adj_df = adj_df.reindex(index=close.index, method='bfill').reindex(columns=close.columns)
     adj_df.to_csv(join(data_path, input_date_str, 'adj_fac.csv'))
+    # cached adjustment factors end before the input date, the last one is carried forward
+    adj_df[stale_list] = adj_df[stale_list].ffill()
 
     tmp_time2 = timer()
     print('---- Finish downloading stock prices. Time consumed: %.3fs.' % (tmp_time2 - tmp_time1))
@@ -177,12 +274,13 @@ def data_merging(futures_df, stocks_df, input_date_str):
     return merged_df
 
 
-def data_wrangling(input_date_df):
+def data_wrangling(input_date_df, deadline=None):
     """
         Download data and perform wrangling according to whether existing price files detected.
+        deadline is passed to data_downloading_fully for running the downloads within their time budgets.
     """
     input_date_str = str(input_date_df.input_date.squeeze().date())
-    futures_df, close_df, adj_df = data_downloading_fully(input_date_df)
+    futures_df, close_df, adj_df = data_downloading_fully(input_date_df, deadline)
     # close_df = pd.read_csv(join(data_path, input_date_str, 'close.csv'), dtype=float, index_col=0, parse_dates=[0])
     # adj_df = pd.read_csv(join(data_path, input_date_str, 'adj_fac.csv'), dtype=float, index_col=0, parse_dates=[0])
     # futures_df = pd.read_csv(join(data_path, input_date_str, 'futures.csv'), dtype=float, index_col=0, parse_dates=[0])
@@ -0,0 +1,162 @@
+import pandas as pd
+import configparser
+import threading
+import os
+
+from datetime import datetime, timedelta
+from os.path import join, isfile
+from timeit import default_timer as timer
+
+from addpath import configfile_path, data_path, output_path
+
+# load the configurations
+config = configparser.ConfigParser()
+config.read(configfile_path)
+
+# stages of the run with their own time budget in seconds by default, in the order they are run
+stages = {'future': 60, 'components': 120, 'stocks': 1200}
+
+
+def deadline_setup():
+    """
+        Set up the run-deadline mode according to the configuration file.
+        The deadline is the next time the clock shows deadline_time. The return of this function will be a dictionary
+    holding the deadline of the run, the budget in seconds of each stage, the timeout of a single vendor request, the
+    start time of the running stage, and the list of degradations recorded so far. If deadline_mode is 0 in the
+    configuration, None is returned and the run behaves as without this mode.
+    """
+    parameters = config['parameters']
+    if int(parameters.get('deadline_mode', '0')) != 1:
+        return None
+    deadline_time = datetime.strptime(parameters.get('deadline_time', '09:00:00'), '%H:%M:%S').time()
+    run_deadline = datetime.combine(datetime.now().date(), deadline_time)
+    if run_deadline <= datetime.now():
+        run_deadline += timedelta(days=1)
+    deadline = {'deadline': run_deadline,
+                'budgets': {stage: float(parameters.get('budget_' + stage, str(budget)))
+                            for stage, budget in stages.items()},
+                'reserve': float(parameters.get('budget_models', '120')),
+                'request_timeout': float(parameters.get('request_timeout', '30')),
+                'stage': None, 'stage_start': None, 'report': []}
+    print('-- Deadline mode on. All data will be collected before %s, leaving %.0fs for modelling.'
+          % (deadline['deadline'].strftime('%Y-%m-%d %H:%M:%S'), deadline['reserve']))
+    return deadline
+
+
+def stage_start(deadline, stage):
+    """
+        Mark the start of a stage, from which its budget is counted.
+    """
+    if deadline is not None:
+        deadline['stage'] = stage
+        deadline['stage_start'] = timer()
+
+
+def stage_remaining(deadline):
+    """
+        Seconds left for the running stage: the smaller of what is left of its budget and what is left before the
+    deadline once the time reserved for modelling is set aside. None if the deadline mode is off.
+    """
+    if deadline is None:
+        return None
+    budget_left = deadline['budgets'][deadline['stage']] - (timer() - deadline['stage_start'])
+    deadline_left = (deadline['deadline'] - datetime.now()).total_seconds() - deadline['reserve']
+    return max(0.0, min(budget_left, deadline_left))
+
+
+def request_timeout(deadline):
+    """
+        Timeout for the next vendor request: the request timeout, capped by what is left for the running stage.
+    None if the deadline mode is off.
+    """
+    if deadline is None:
+        return None
+    return min(deadline['request_timeout'], stage_remaining(deadline))
+
+
+def call_with_timeout(deadline, func, *args, **kwargs):
+    """
+        Call func(*args, **kwargs) and give up waiting after request_timeout(deadline) seconds.
+        The call runs in a daemon thread, so a straggler is left behind instead of blocking the run; it stops by
+    itself when the timeout passed to requests expires. The return of this function will be a tuple (result, status)
+    where status is 'ok', 'timeout' or 'error'. If the deadline mode is off, func is called directly.
+    """
+    if deadline is None:
+        return func(*args, **kwargs), 'ok'
+    timeout = request_timeout(deadline)
+    if timeout <= 0:
+        return None, 'timeout'
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = func(*args, **kwargs)
+        except Exception as error:
+            outcome['error'] = error
+
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    worker.join(timeout)
+    if worker.is_alive():
+        return None, 'timeout'
+    if 'error' in outcome:
+        return None, 'error'
+    return outcome['result'], 'ok'
+
+
+def cached_data(file_name, input_date_str, parse_dates=True):
+    """
+        Load the latest file saved by an earlier run, before the input date, from data_path. The index is parsed as
+    dates if parse_dates is True.
+        The return of this function will be a tuple (data frame, date string of the cache), or (None, None) if no
+    earlier run saved this file.
+    """
+    if not os.path.exists(data_path):
+        return None, None
+    cache_dates = sorted([folder for folder in os.listdir(data_path)
+                          if folder < input_date_str and isfile(join(data_path, folder, file_name))], reverse=True)
+    for cache_date in cache_dates:
+        try:
+            cached_df = pd.read_csv(join(data_path, cache_date, file_name), index_col=0,
+                                    parse_dates=[0] if parse_dates else False)
+        except (ValueError, pd.errors.ParserError):
+            continue
+        return cached_df, cache_date
+    return None, None
+
+
+def record_degradation(deadline, item, action, reason, cache_date=None):
+    """
+        Record that an item of the running stage was degraded.
+        action is 'cached' when the last cached values are reused (the values are stale, as of cache_date), and
+    'dropped' when the item is left out of the run. reason tells why, e.g. a request that timed out and was
+    abandoned, or a stage budget used up before the item was reached. An item recorded again in the same stage, e.g.
+    a stock loaded from the cache and then dropped for missing prices, keeps only its latest record.
+    """
+    if deadline is None:
+        return
+    deadline['report'] = [entry for entry in deadline['report']
+                          if (entry['stage'], entry['item']) != (deadline['stage'], item)]
+    deadline['report'].append({'stage': deadline['stage'], 'item': item, 'action': action, 'reason': reason,
+                               'stale': action == 'cached', 'cache_date': cache_date})
+
+
+def degradation_report(deadline, input_date_str):
+    """
+        Save and print the report of what was degraded to meet the deadline.
+        The report will be saved as degradation_report.csv in the output folder of the input date. The return of this
+    function will be the report as a data frame, empty if nothing was degraded.
+    """
+    report_df = pd.DataFrame(deadline['report'] if deadline is not None else [],
+                             columns=['stage', 'item', 'action', 'reason', 'stale', 'cache_date'])
+    if deadline is None:
+        return report_df
+    report_df.to_csv(join(output_path, input_date_str, 'degradation_report.csv'), index=False)
+    if report_df.empty:
+        print('-- Deadline met without degradation.')
+    else:
+        summary = report_df.groupby(['stage', 'action']).size()
+        print('-- Deadline met with degradation. Check \'degradation_report.csv\' in the \'output\' folder.')
+        for (stage, action), size in summary.items():
+            print('---- %s: %d item(s) %s.' % (stage, size, action))
+    return report_df
@@ -4,6 +4,8 @@ import requests
 import traceback
 import pandas as pd
 
+from algorithm.payload_decoding import load_payload, records_to_columns, stamps_to_datetime64, sort_columns
+
 def get_HisMainContract(variety=None, start=None, end=None):
     start_ = str(datetime.datetime.strptime(start, '%Y-%m-%d'))[:19]
     start_ = start_.replace('-', '').replace(':', '').replace(' ', '')
@@ -68,7 +70,11 @@ def freq2dataType(freq=None):
         return 60 * 60 * 24
 
 
-def get_hisBar(symbol=None, exchange=None, freq=None, start=None, end=None, count=None):
+hisBar_columns = ['symbol', 'exchange', 'bar_type', 'time', 'pre_close', 'open', 'high', 'low', 'close', 'volume',
+                  'turnover', 'open_interest', 'settlement']
+
+
+def hisBar_request(symbol=None, exchange=None, freq=None, start=None, end=None, count=None):
     exchange_ = exchange2num(exchange)
     dataType = freq2dataType(freq=freq)
     url = ''
@@ -98,36 +104,85 @@ def get_hisBar(symbol=None, exchange=None, freq=None, start=None, end=None, coun
         body['end'] = end_
         body['count'] = count_
         url = "https://apigateway.inquantstudio.com/api/MarketData/GetPreviousBar"
+    return url, body, dataType
+
+
+def hisBar_post(url, body, timeout=None):
+    """
+    Post a request built by hisBar_request and return the raw bytes of the response, or None if it failed.
+    timeout is the number of seconds to wait for the vendor (None: no limit).
+    """
     try:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.1.6) Gecko/20091201 Firefox/3.5.6",
             "Content-Type": "application/json"}
-        response = requests.post(url, data=json.dumps(body), headers=headers)
+        response = requests.post(url, data=json.dumps(body), headers=headers, timeout=timeout)
         response.close()
     except Exception:
         print(traceback.format_exc())
         return None
-    else:
-        response = response.content.decode()
-        response_json = json.loads(response)
-        data = response_json.get('data')
-        df_data = pd.DataFrame(data)
-        if df_data.empty:
-            return df_data
-        df_data.columns = ['symbol', 'exchange', 'bar_type', 'time', 'pre_close', 'open', 'high', 'low', 'close',
-                           'volume',
-                           'turnover', 'open_interest', 'settlement']
-        if start and end and not count:
-            if start == end and dataType == 86400:
-                begin = start.replace('-', '').replace(' ', '').replace(':', '')
-                end = end.replace('-', '').replace(' ', '').replace(':', '')
-                if len(begin) == 8:
-                    begin += '000000'
-                if len(end) == 8:
-                    end += '000000'
-                df_data = df_data[(df_data["time"] >= int(begin)) & (df_data["time"] <= int(end))]
-        if not start and end and count:
-            if dataType == 86400 and count == 1:
-                df_data = df_data[-1:]
-        df_data_ = df_data.sort_values(by='time').reset_index(drop=True)
-        return df_data_
+    return response.content
+
+
+def get_hisBar(symbol=None, exchange=None, freq=None, start=None, end=None, count=None, timeout=None):
+    url, body, dataType = hisBar_request(symbol=symbol, exchange=exchange, freq=freq, start=start, end=end,
+                                         count=count)
+    content = hisBar_post(url, body, timeout=timeout)
+    if content is None:
+        return None
+    data = load_payload(content, 'data')
+    df_data = pd.DataFrame(data)
+    if df_data.empty:
+        return df_data
+    df_data.columns = hisBar_columns
+    if start and end and not count:
+        if start == end and dataType == 86400:
+            begin = start.replace('-', '').replace(' ', '').replace(':', '')
+            end = end.replace('-', '').replace(' ', '').replace(':', '')
+            if len(begin) == 8:
+                begin += '000000'
+            if len(end) == 8:
+                end += '000000'
+            df_data = df_data[(df_data["time"] >= int(begin)) & (df_data["time"] <= int(end))]
+    if not start and end and count:
+        if dataType == 86400 and count == 1:
+            df_data = df_data[-1:]
+    df_data_ = df_data.sort_values(by='time').reset_index(drop=True)
+    return df_data_
+
+
+def get_hisBar_columns(symbol=None, exchange=None, freq=None, start=None, end=None, count=None, timeout=None):
+    """
+    Column-oriented version of get_hisBar. The payload is decoded directly into typed NumPy arrays instead of a
+    DataFrame: 'time' as int64 stamps (YYYYMMDDhhmmss), 'times' as datetime64[ns], prices and volumes as float64.
+    Rows are sorted ascending by time, and the same filters as get_hisBar are applied. timeout is the number of
+    seconds to wait for the vendor (None: no limit).
+    """
+    url, body, dataType = hisBar_request(symbol=symbol, exchange=exchange, freq=freq, start=start, end=end,
+                                         count=count)
+    content = hisBar_post(url, body, timeout=timeout)
+    if content is None:
+        return None
+    records = load_payload(content, 'data')
+    # records are either lists in the order of hisBar_columns, or dicts whose keys follow that order
+    keys = list(records[0]) if records and isinstance(records[0], dict) else list(range(len(hisBar_columns)))
+    fields = {'time': (keys[hisBar_columns.index('time')], 'int64')}
+    for name in hisBar_columns[4:]:
+        fields[name] = (keys[hisBar_columns.index(name)], 'float64')
+    columns = records_to_columns(records, fields)
+    if start and end and not count:
+        if start == end and dataType == 86400:
+            begin = start.replace('-', '').replace(' ', '').replace(':', '')
+            end = end.replace('-', '').replace(' ', '').replace(':', '')
+            if len(begin) == 8:
+                begin += '000000'
+            if len(end) == 8:
+                end += '000000'
+            mask = (columns['time'] >= int(begin)) & (columns['time'] <= int(end))
+            columns = {name: values[mask] for name, values in columns.items()}
+    if not start and end and count:
+        if dataType == 86400 and count == 1:
+            columns = {name: values[-1:] for name, values in columns.items()}
+    columns = sort_columns(columns, 'time')
+    columns['times'] = stamps_to_datetime64(columns['time'])
+    return columns
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+
+
+def kalman_init(stock_prices, future_prices, weights, delta):
+    """
+        Initialize the state of the dynamic hedge from a static basket, e.g. the LASSO coefficients.
+        The future is modelled as future_t = intercept_t + stock_prices_t @ weights_t + noise_t, where the intercept
+    and the weights follow random walks. The state starts at the static basket with the intercept set to the mean
+    residual; its covariance is the OLS covariance over the training window, the observation variance is the variance
+    of the static residuals, and the daily state noise is delta times the observation variance, scaled by the inverse
+    second moments of the prices, so that delta is the share of the observation variance added per day and per state.
+        The return of this function will be a dictionary of {'state', 'cov', 'noise', 'obs_var', 'price', 'price_var'},
+    where price holds the last stock prices the state has seen and price_var the mean squared daily price changes,
+    the same statistic as kalman_update keeps up to date.
+    """
+    design = np.column_stack([np.ones(len(future_prices)), stock_prices])
+    weights = np.asarray(weights, dtype=np.float64)
+    intercept = np.mean(future_prices - stock_prices @ weights)
+    residuals = future_prices - intercept - stock_prices @ weights
+    obs_var = max(residuals.var(), 1e-12)
+
+    moments = design.T @ design
+    moments += 1e-8 * np.trace(moments) / moments.shape[0] * np.eye(moments.shape[0])  # guard collinear prices
+    moments_inv = np.linalg.inv(moments)
+    kalman_state = {'state': np.r_[intercept, weights],
+                    'cov': obs_var * moments_inv,
+                    'noise': delta * obs_var * len(future_prices) * moments_inv,
+                    'obs_var': obs_var,
+                    'price': np.asarray(stock_prices[-1], dtype=np.float64),
+                    'price_var': (np.diff(stock_prices, axis=0) ** 2).mean(axis=0) if len(stock_prices) > 1
+                    else np.zeros(stock_prices.shape[1])}
+    return kalman_state
+
+
+def kalman_predict(kalman_state):
+    """
+        Move the state one day ahead: the mean is unchanged under the random walk, the covariance grows by the noise.
+    """
+    kalman_state['cov'] = kalman_state['cov'] + kalman_state['noise']
+    return kalman_state
+
+
+def kalman_spread(kalman_state, stock_price, future_price):
+    """
+        Compute the spread of one day with the predicted state, before the day is used to update it.
+        The spread is defined as in the static case, portfolio value minus future price. The return of this function
+    will be a tuple (spread, equilibrium, variance): the equilibrium is the expected spread, minus the intercept, and
+    the variance is the one of the one-step-ahead prediction error.
+    """
+    design = np.r_[1.0, stock_price]
+    spread = stock_price @ kalman_state['state'][1:] - future_price
+    equilibrium = -kalman_state['state'][0]
+    variance = design @ kalman_state['cov'] @ design + kalman_state['obs_var']
+    return spread, equilibrium, variance
+
+
+def kalman_update(kalman_state, stock_price, future_price, decay=1.0):
+    """
+        Update the predicted state with the prices of one day, in O(k^2) for k states.
+        The weights are projected back to non-negative values afterwards, as stocks can only be held long. The
+    observation variance is then updated as an exponentially weighted average with weight decay on the old value: the
+    new observation is the squared prediction error less the part explained by the state covariance (floored at 0).
+    The mean squared daily price changes are updated in the same way. A decay of 1 keeps both fixed.
+    """
+    design = np.r_[1.0, stock_price]
+    cov = kalman_state['cov']
+    cov_design = cov @ design
+    state_variance = design @ cov_design
+    variance = state_variance + kalman_state['obs_var']
+    gain = cov_design / variance
+    error = future_price - design @ kalman_state['state']
+    state = kalman_state['state'] + gain * error
+    state[1:] = np.maximum(state[1:], 0)
+    kalman_state['state'] = state
+    kalman_state['cov'] = cov - np.outer(gain, cov_design)
+    obs_var = decay * kalman_state['obs_var'] + (1 - decay) * max(error ** 2 - state_variance, 0.0)
+    kalman_state['obs_var'] = max(obs_var, 1e-12)
+    stock_price = np.asarray(stock_price, dtype=np.float64)
+    price_change = stock_price - kalman_state['price']
+    kalman_state['price_var'] = decay * kalman_state['price_var'] + (1 - decay) * price_change ** 2
+    kalman_state['price'] = stock_price
+    return kalman_state
+
+
+def kalman_step(kalman_state, stock_price, future_price, decay=1.0):
+    """
+        Predict and update the state with the prices of one day.
+    """
+    return kalman_update(kalman_predict(kalman_state), stock_price, future_price, decay)
+
+
+def kalman_drop(kalman_state, keep):
+    """
+        Remove the weights not kept, e.g. for stocks dropped from the data, without moving the spread. keep is a
+    boolean array over the weights; the intercept is always kept.
+        The value of the dropped stocks at their last prices, weight times price, is folded into the intercept, so
+    that the fitted future price stays the same. The covariance and the noise are mapped by the same linear map, which
+    moves the uncertainty of the dropped weights, at the last prices, to the intercept. As the prices of the dropped
+    stocks keep moving unobserved, the mean squared daily change of their value, weight squared times price_var, is
+    then added to the variance and to the daily noise of the intercept.
+    """
+    dropped = ~np.asarray(keep, dtype=bool)
+    keep = np.r_[True, keep]
+    fold = np.eye(keep.size)[keep]
+    fold[0, ~keep] = np.r_[1.0, kalman_state['price']][~keep]
+    value_var = (kalman_state['state'][1:][dropped] ** 2 * kalman_state['price_var'][dropped]).sum()
+    kalman_state['state'] = fold @ kalman_state['state']
+    kalman_state['cov'] = fold @ kalman_state['cov'] @ fold.T
+    kalman_state['noise'] = fold @ kalman_state['noise'] @ fold.T
+    kalman_state['cov'][0, 0] += value_var
+    kalman_state['noise'][0, 0] += value_var
+    kalman_state['price'] = kalman_state['price'][~dropped]
+    kalman_state['price_var'] = kalman_state['price_var'][~dropped]
+    return kalman_state
+
+
+def kalman_state_to_df(kalman_state, tickers, date):
+    """
+        Convert the state into a data frame with one row per state ('intercept' and the tickers), for saving. The
+    price and price_var columns hold the last stock prices and their mean squared daily changes, 1 and 0 for the
+    intercept.
+    """
+    names = ['intercept'] + list(tickers)
+    state_df = pd.DataFrame({'date': str(date), 'obs_var': kalman_state['obs_var'], 'state': kalman_state['state'],
+                             'price': np.r_[1.0, kalman_state['price']],
+                             'price_var': np.r_[0.0, kalman_state['price_var']]}, index=pd.Index(names, name='name'))
+    state_df = state_df.join(pd.DataFrame(kalman_state['cov'], index=names, columns=['cov_' + n for n in names]))
+    state_df = state_df.join(pd.DataFrame(kalman_state['noise'], index=names, columns=['noise_' + n for n in names]))
+    return state_df
+
+
+def kalman_state_from_df(state_df):
+    """
+        Convert a data frame saved by kalman_state_to_df back into the state.
+        The return of this function will be a tuple (state, tickers, date string of the last update).
+    """
+    names = state_df.index.tolist()
+    kalman_state = {'state': state_df['state'].to_numpy(dtype=np.float64),
+                    'cov': state_df[['cov_' + n for n in names]].to_numpy(dtype=np.float64),
+                    'noise': state_df[['noise_' + n for n in names]].to_numpy(dtype=np.float64),
+                    'obs_var': float(state_df['obs_var'].iloc[0]),
+                    'price': state_df['price'].to_numpy(dtype=np.float64)[1:],
+                    'price_var': state_df['price_var'].to_numpy(dtype=np.float64)[1:]}
+    return kalman_state, names[1:], str(state_df['date'].iloc[0])
@@ -2,14 +2,18 @@ import numpy as np
 import pandas as pd
 import configparser
 import shutil
+import os
 
-from os.path import join
+from os.path import join, isfile
 from sklearn.linear_model import Lasso
 from statsmodels.tsa.ar_model import AutoReg
 from arch import arch_model
 from timeit import default_timer as timer
 
 from addpath import configfile_path, output_path
+from algorithm.batched_garch import garch_batch_fit
+from algorithm.kalman_hedge import kalman_init, kalman_predict, kalman_spread, kalman_update, kalman_step, \
+    kalman_drop, kalman_state_to_df, kalman_state_from_df
 
 # load the configurations
 config = configparser.ConfigParser()
@@ -35,10 +39,14 @@ def lASSO_training(input_date_str, training_df):
         for coef in coef_list:
             f.write(f"{coef}\n")
         f.close()
-    # copy the coefficient file outside the detailed date folder for easier loading later
-    src = join(output_path, input_date_str, 'LASSO_coef.txt')
-    dst = join(output_path, 'LASSO_coef.txt')
-    shutil.copyfile(src, dst)
+    # save them keyed by ticker as well, so that they can be matched to the stocks of a later run
+    coef_df = pd.DataFrame({'coef': coef_list}, index=pd.Index(training_df.columns[1:], name='ticker'))
+    coef_df.to_csv(join(output_path, input_date_str, 'LASSO_coef.csv'), index=True)
+    # copy the coefficient files outside the detailed date folder for easier loading later
+    for file_name in ['LASSO_coef.txt', 'LASSO_coef.csv']:
+        src = join(output_path, input_date_str, file_name)
+        dst = join(output_path, file_name)
+        shutil.copyfile(src, dst)
 
     tmp_time2 = timer()
     print('-- Finish portfolio rebalancing. Time consumed: %.3fs.' % (tmp_time2 - tmp_time1))
@@ -55,6 +63,7 @@ def model_training(input_date_str, training_df, portfolio_allocation_list):
     AR_p = int(config['parameters']['ar_p'])
     GARCH_p = int(config['parameters']['garch_p'])
     GARCH_q = int(config['parameters']['garch_q'])
+    GARCH_engine = config['parameters'].get('garch_engine', 'arch')
 
     # compute training residuals
     Matrix = training_df.drop(training_df.columns[0:1], axis=1, inplace=False).to_numpy()
@@ -76,13 +85,15 @@ def model_training(input_date_str, training_df, portfolio_allocation_list):
     AR_param_df = pd.DataFrame([{'alpha': alpha, 'beta': beta, 'sigma2': sigma2, 'equilibrium': equilibrium, 'sd': sd}])
     AR_param_df.to_csv(join(output_path, input_date_str, 'AR_param_df.csv'), index=False)
 
-    # train a GARCH model for volatility bounds using the training data
-    model_GARCH = arch_model(residuals_train, p=GARCH_p, q=GARCH_q)
-    model_GARCH_fitted = model_GARCH.fit(disp='off')
-
-    # collect estimated volatility from the GARCH model
-    pred_result = model_GARCH_fitted.forecast(horizon=1)
-    pred_volatility = np.sqrt(pred_result.variance.values[-1, :][0])
+    # train a GARCH model for volatility bounds using the training data, and collect the estimated volatility
+    if GARCH_engine == 'batched':
+        model_GARCH_fitted = garch_batch_fit(residuals_train, p=GARCH_p, q=GARCH_q)
+        pred_volatility = model_GARCH_fitted.pred_volatility[0]
+    else:
+        model_GARCH = arch_model(residuals_train, p=GARCH_p, q=GARCH_q)
+        model_GARCH_fitted = model_GARCH.fit(disp='off')
+        pred_result = model_GARCH_fitted.forecast(horizon=1)
+        pred_volatility = np.sqrt(pred_result.variance.values[-1, :][0])
     GARCH_param_df = pd.DataFrame([{'pred_volatility': pred_volatility}])
     GARCH_param_df.to_csv(join(output_path, input_date_str, 'GARCH_param_df.csv'), index=False)
 
@@ -92,4 +103,86 @@ def model_training(input_date_str, training_df, portfolio_allocation_list):
     return AR_param_df, GARCH_param_df
 
 
+def kalman_training(input_date_str, training_df, testing_df, portfolio_allocation_list, rebalance_status):
+    """
+        Update the weights of the stock portfolio, and the equilibrium level and volatility of the spread, with a
+    Kalman filter, as an alternative to the static LASSO weights with the AR and GARCH models.
+        The filter starts from the stocks selected by LASSO on rebalancing days, or when there is no saved state, and
+    otherwise continues from the state saved by the latest earlier run, taking one O(k^2) step per new day instead of
+    refitting on the whole training set. The state after the input date is saved as kalman_state.csv, and the
+    parameters as AR_param_df.csv and GARCH_param_df.csv, as for the LASSO weights.
+        The return of this function will be a tuple (portfolio_allocation_list, AR_param_df, GARCH_param_df), with
+    the weights for the input date, and the 'equilibrium' and 'pred_volatility' used by signal_generating_func.
+    """
+    print('-- Start updating the Kalman filter.')
+    tmp_time1 = timer()
+    delta = float(config['parameters'].get('kalman_delta', '0.0001'))
+    decay = float(config['parameters'].get('kalman_decay', '0.97'))
+    tickers = list(training_df.columns[1:])
+    stock_prices = training_df.iloc[:, 1:].to_numpy(dtype=np.float64)
+    future_prices = training_df.iloc[:, 0].to_numpy(dtype=np.float64)
+
+    # load the state saved by the latest earlier run, unless the portfolio is rebalanced. the filter restarts from
+    # the LASSO coefficients as well if the state predates the latest rebalance, e.g. one run with the LASSO engine,
+    # or if it is older than the training set, as the days in between could not be caught up
+    state_df = None
+    if not rebalance_status and os.path.exists(output_path):
+        folders = [folder for folder in os.listdir(output_path) if folder < input_date_str]
+        state_dates = sorted([folder for folder in folders if isfile(join(output_path, folder, 'kalman_state.csv'))])
+        rebalance_dates = sorted([folder for folder in folders if isfile(join(output_path, folder, 'LASSO_coef.csv'))])
+        if state_dates and rebalance_dates and state_dates[-1] < rebalance_dates[-1]:
+            print('---- The saved Kalman state predates the rebalance on %s, and is restarted.' % rebalance_dates[-1])
+        elif state_dates:
+            state_df = pd.read_csv(join(output_path, state_dates[-1], 'kalman_state.csv'), index_col=0)
+            if pd.Timestamp(state_df['date'].iloc[0]) < training_df.index[0]:
+                print('---- The saved Kalman state is older than the training set, and is restarted.')
+                state_df = None
+
+    if state_df is None:
+        # start from the stocks selected by LASSO, at the end of the training set
+        support = np.asarray(portfolio_allocation_list) > 0
+        kalman_state = kalman_init(stock_prices[:, support], future_prices,
+                                   np.asarray(portfolio_allocation_list)[support], delta)
+        state_tickers = [ticker for ticker, selected in zip(tickers, support) if selected]
+        print('---- Kalman filter started from %d stocks selected by LASSO.' % len(state_tickers))
+    else:
+        kalman_state, state_tickers, state_date = kalman_state_from_df(state_df)
+        # stocks no longer in the data are removed from the state, their value at the last prices being folded into
+        # the intercept
+        keep = np.asarray([ticker in tickers for ticker in state_tickers], dtype=bool)
+        if not keep.all():
+            print('---- %d stock(s) missing from the data are folded into the intercept of the Kalman filter.'
+                  % (~keep).sum())
+            kalman_state = kalman_drop(kalman_state, keep)
+            state_tickers = [ticker for ticker in state_tickers if ticker in tickers]
+        # catch up with the days between the saved state and the input date
+        columns = [tickers.index(ticker) for ticker in state_tickers]
+        for t in np.flatnonzero(training_df.index > pd.Timestamp(state_date)):
+            kalman_state = kalman_step(kalman_state, stock_prices[t, columns], future_prices[t], decay)
+    columns = [tickers.index(ticker) for ticker in state_tickers]
+
+    # compute the spread of the input date with the predicted state, then update the state with it
+    stock_price = testing_df.iloc[-1, 1:].to_numpy(dtype=np.float64)[columns]
+    future_price = float(testing_df.iloc[-1, 0])
+    kalman_state = kalman_predict(kalman_state)
+    spread, equilibrium, variance = kalman_spread(kalman_state, stock_price, future_price)
+    allocation_array = np.zeros(len(tickers))
+    allocation_array[columns] = kalman_state['state'][1:]
+    portfolio_allocation_list = list(allocation_array)
+    kalman_state = kalman_update(kalman_state, stock_price, future_price, decay)
+
+    state_df = kalman_state_to_df(kalman_state, state_tickers, testing_df.index[-1].date())
+    state_df.to_csv(join(output_path, input_date_str, 'kalman_state.csv'), index=True)
+    AR_param_df = pd.DataFrame([{'equilibrium': equilibrium, 'sd': np.sqrt(variance)}])
+    AR_param_df.to_csv(join(output_path, input_date_str, 'AR_param_df.csv'), index=False)
+    GARCH_param_df = pd.DataFrame([{'pred_volatility': np.sqrt(variance)}])
+    GARCH_param_df.to_csv(join(output_path, input_date_str, 'GARCH_param_df.csv'), index=False)
+    # the quantities specific to the filter: the spread before the update and the observation variance after it
+    Kalman_param_df = pd.DataFrame([{'spread': spread, 'obs_var': kalman_state['obs_var'],
+                                     'n_stocks': len(state_tickers)}])
+    Kalman_param_df.to_csv(join(output_path, input_date_str, 'Kalman_param_df.csv'), index=False)
+
+    tmp_time2 = timer()
+    print('-- Finish updating the Kalman filter. Time consumed: %.3fs.' % (tmp_time2 - tmp_time1))
 
+    return portfolio_allocation_list, AR_param_df, GARCH_param_df
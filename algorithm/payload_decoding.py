@@ -0,0 +1,90 @@
+import json
+import numpy as np
+import pandas as pd
+
+from operator import itemgetter
+
+
+def load_payload(content, key=None):
+    """
+        Decode the raw bytes of a vendor response.
+        json.loads accepts bytes directly, so the intermediate str copy made by .decode() is skipped. If a key is
+    given, only the corresponding part of the payload is returned.
+    """
+    payload = json.loads(content)
+    if key is not None:
+        payload = payload.get(key) if isinstance(payload, dict) else None
+    return payload if payload is not None else []
+
+
+def records_to_columns(records, fields):
+    """
+        Convert a list of records into typed NumPy columns in one pass per field.
+        records can be a list of dicts (fields are keys) or a list of lists (fields are positions). fields is a
+    dictionary of {name: (key, dtype)}. Values sent as numeric strings are converted by NumPy, not per-row Python;
+    a dtype of None keeps the type NumPy infers from the values.
+    The return of this function will be a dictionary of {name: np.ndarray}.
+    """
+    n = len(records)
+    columns = {}
+    for name, (key, dtype) in fields.items():
+        if n == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+            continue
+        values = np.asarray(list(map(itemgetter(key), records)))
+        columns[name] = values if dtype is None else values.astype(dtype, copy=False)
+    return columns
+
+
+def stamps_to_datetime64(stamps, date_only=False):
+    """
+        Convert integer time stamps formatted as YYYYMMDDhhmmss (or YYYYMMDD) into datetime64[ns], vectorized.
+        This is the format the vendors send, as integers or digit strings. Stamps in any other format, e.g.
+    '2022-06-15 00:00:00', are parsed by pd.to_datetime instead, and a ValueError is raised if they cannot be.
+        If date_only is True, the hh:mm:ss part is truncated, which is the same as parsing str(stamp // 10**6)
+    with the format '%Y%m%d'.
+    """
+    stamps = np.asarray(stamps)
+    if stamps.dtype.kind not in 'iuf':
+        stamps = stamps.astype(str)
+        if not np.all(np.char.isdigit(stamps)):
+            result = pd.to_datetime(stamps).to_numpy(dtype='datetime64[ns]')
+            return result.astype('datetime64[D]').astype('datetime64[ns]') if date_only else result
+    stamps = stamps.astype(np.int64)
+    stamps = np.where(stamps < 10 ** 8, stamps * 10 ** 6, stamps)  # YYYYMMDD without the time part
+    date, clock = np.divmod(stamps, 10 ** 6)
+    year, month_day = np.divmod(date, 10 ** 4)
+    month, day = np.divmod(month_day, 100)
+    months = (year - 1970) * 12 + (month - 1)
+    result = months.astype('datetime64[M]').astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    result = result.astype('datetime64[ns]')
+    if not date_only:
+        hour, minute_second = np.divmod(clock, 10 ** 4)
+        minute, second = np.divmod(minute_second, 100)
+        result = result + (hour * 3600 + minute * 60 + second).astype('timedelta64[s]')
+    return result
+
+
+def sort_columns(columns, by):
+    """
+        Sort all columns in ascending order of the column named by, keeping rows aligned.
+        Vendors return bars either newest-first or in arbitrary order; a stable argsort keeps equal stamps in
+    their original order.
+    """
+    key = columns[by]
+    if key.size < 2 or np.all(key[1:] >= key[:-1]):
+        return columns
+    if np.all(key[1:] <= key[:-1]):  # newest-first, a reversed view is enough
+        return {name: values[::-1] for name, values in columns.items()}
+    order = np.argsort(key, kind='stable')
+    return {name: values[order] for name, values in columns.items()}
+
+
+def slice_columns(columns, by, start=None, end=None):
+    """
+        Keep the rows whose column named by lies in [start, end], both ends included. columns must be sorted.
+    """
+    key = columns[by]
+    lo = 0 if start is None else np.searchsorted(key, np.datetime64(start, 'ns'), side='left')
+    hi = key.size if end is None else np.searchsorted(key, np.datetime64(end, 'ns'), side='right')
+    return {name: values[lo:hi] for name, values in columns.items()}
@@ -1,39 +1,75 @@
 import pandas as pd
-import json
+import numpy as np
 import requests
 import urllib3
 import tushare as ts
 
-# this function is to get the corresponding code within the database for stocks
-def getInnercode():
+from algorithm.payload_decoding import load_payload, records_to_columns, stamps_to_datetime64, sort_columns
+
+header = {
+    "User-Agent": "Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.1.6) Gecko/20091201 Firefox/3.5.6",
+    "Content-Type": "application/json"}
+
+# this function is to request the corresponding codes from the database, returning the raw bytes of the response
+def requestInnercode(timeout=None):
     urlstr = "https://stq.niuguwang.com/ft/innercode"
-    header = {
-        "User-Agent": "Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.1.6) Gecko/20091201 Firefox/3.5.6",
-        "Content-Type": "application/json"}
-    Innercode = requests.get(urlstr, headers=header)
-    Innercode_dict = json.loads(Innercode.content.decode("utf-8"))
-    result = pd.DataFrame.from_dict(Innercode_dict["data"])
+    Innercode = requests.get(urlstr, headers=header, timeout=timeout)
+    return Innercode.content
+
+# this function is to get the corresponding code within the database for stocks
+def getInnercode(timeout=None):
+    records = load_payload(requestInnercode(timeout), "data")
+    result = pd.DataFrame.from_dict(records)
+    return result
+
+# this function is the column-oriented version of getInnercode, returning a {TradingCode: InnerCode} dictionary
+def getInnercodeColumns(timeout=None):
+    records = load_payload(requestInnercode(timeout), "data")
+    columns = records_to_columns(records, {"TradingCode": ("TradingCode", str), "InnerCode": ("InnerCode", "int64")})
+    result = dict(zip(columns["TradingCode"].tolist(), columns["InnerCode"].tolist()))
     return result
 
+# this function is to request the data from database, returning the raw bytes of the response
+def requestAShrData(innercode, ktype, enddate, count, adj=True, timeout=None):
+    urlstr = "https://shqa.niuguwang.com/aquote/quote/kline.ashx?code={}&type={}&start={}&count={}&ex={}".format(
+        innercode, ktype, enddate, count, int(adj))
+    AShrData = requests.get(urlstr, headers=header, timeout=timeout)
+    return AShrData.content
+
 # this function is to download the data from database
-def getAShrData(innercode, ktype, enddate, count, adj=True):
+def getAShrData(innercode, ktype, enddate, count, adj=True, timeout=None):
     """
     innercode : int
     ktype : int 1:5min; 2:15min; 3:30min; 4:60min; 5:1d; 6:1w; 9:1m, 11:1min
     enddate : str (not included)
     count : int
     adj : True/False
+    timeout : float, seconds to wait for the vendor (None: no limit)
     """
-    urlstr = "https://shqa.niuguwang.com/aquote/quote/kline.ashx?code={}&type={}&start={}&count={}&ex={}".format(
-        innercode, ktype, enddate, count, int(adj))
-    header = {
-        "User-Agent": "Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.1.6) Gecko/20091201 Firefox/3.5.6",
-        "Content-Type": "application/json"}
-    AShrData = requests.get(urlstr, headers=header)
-    AShrData_dict = json.loads(AShrData.content.decode("utf-8"))
-    result = pd.DataFrame.from_dict(AShrData_dict["timedata"])
+    records = load_payload(requestAShrData(innercode, ktype, enddate, count, adj, timeout), "timedata")
+    result = pd.DataFrame.from_dict(records)
     return result
 
+# this function is the column-oriented version of getAShrData, decoding the payload directly into typed columns
+def getAShrColumns(innercode, ktype, enddate, count, adj=True, timeout=None):
+    """
+    innercode : int
+    ktype : int 1:5min; 2:15min; 3:30min; 4:60min; 5:1d; 6:1w; 9:1m, 11:1min
+    enddate : str (not included)
+    count : int
+    adj : True/False
+    timeout : float, seconds to wait for the vendor (None: no limit)
+    return : dict of {'times': datetime64[ns], 'nowv': float64}, sorted ascending by time.
+             'nowv' is converted from cents to yuan.
+    The vendor sends 'times' as YYYYMMDDhhmmss integers (or digit strings); other formats, e.g.
+    '2022-06-15 00:00:00', are parsed by pandas instead of the vectorized path.
+    """
+    records = load_payload(requestAShrData(innercode, ktype, enddate, count, adj, timeout), "timedata")
+    columns = records_to_columns(records, {"times": ("times", None), "nowv": ("nowv", "float64")})
+    columns["times"] = stamps_to_datetime64(columns["times"])
+    columns["nowv"] = columns["nowv"] / 100
+    return sort_columns(columns, "times")
+
 # this function is to download the adjustment factors from the database
 def getAdjFactor(ticker, startdate, enddate):
     startdate = startdate.strftime('%Y%m%d')
@@ -50,8 +86,8 @@ def getAdjFactor(ticker, startdate, enddate):
     adjfactor_df = adjfactor_df.round(decimals=3)
     return adjfactor_df
 
-# this function is to get the component of indexes
-def getIndexComponents(idxcode, startdate, enddate):
+# this function is to request the component of indexes, returning the raw bytes of the response
+def requestIndexComponents(idxcode, startdate, enddate, timeout=600):
     urlstr = "https://stq.niuguwang.com/NorthJg/GetNorthJg/hsweighthk"
     parms = {
         'sdate': startdate,
@@ -64,7 +100,29 @@ def getIndexComponents(idxcode, startdate, enddate):
         'Connection': 'close'
     }
     urllib3.disable_warnings()
-    IndexComponents = requests.get(urlstr, data=parms, headers=headers, verify=False, timeout=600)
-    IndexComponents_dict = json.loads(IndexComponents.content.decode("utf-8"))
+    IndexComponents = requests.get(urlstr, data=parms, headers=headers, verify=False, timeout=timeout)
+    return IndexComponents.content
+
+# this function is to get the component of indexes
+def getIndexComponents(idxcode, startdate, enddate, timeout=600):
+    IndexComponents_dict = load_payload(requestIndexComponents(idxcode, startdate, enddate, timeout))
     result = pd.DataFrame.from_dict(IndexComponents_dict)
     return result
+
+# this function is the column-oriented version of getIndexComponents, returning the unique tickers as an array
+def getIndexTickers(idxcode, startdate, enddate, timeout=600):
+    payload = load_payload(requestIndexComponents(idxcode, startdate, enddate, timeout))
+    if isinstance(payload, dict):  # columns stored as {column: {row: value}} or {column: [values]}
+        if not payload:  # no components in the window, an empty array lets the caller look further back
+            return np.empty(0, dtype=str)
+        if 'ticker' not in payload:
+            raise ValueError("index components payload has no 'ticker' column: %s" % list(payload)[:10])
+        tickers = payload['ticker']
+        if isinstance(tickers, dict):
+            tickers = list(tickers.values())
+    elif isinstance(payload, list):  # records stored as [{column: value}]
+        tickers = [record['ticker'] for record in payload]
+    else:
+        raise ValueError("unexpected index components payload of type %s" % type(payload).__name__)
+    result = np.unique(np.asarray(tickers, dtype=str))
+    return result
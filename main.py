@@ -6,11 +6,12 @@ import os
 import math
 
 from datetime import datetime
-from os.path import join
+from os.path import join, isfile
 
 import algorithm.data_wrangling as data_wrangling
 import algorithm.model as model
 from addpath import configfile_path, data_path, output_path
+from algorithm.deadline import deadline_setup, degradation_report
 from algorithm.signal_generating import signal_generating_func
 
 if __name__ == '__main__':
@@ -23,6 +24,7 @@ if __name__ == '__main__':
     initialization_status = int(config['parameters']['initialization_status'])
     future_index = config['parameters']['stock_pool']
     spare_future_margin_ratio = float(config['parameters']['spare_future_margin_ratio'])
+    hedge_engine = config['parameters'].get('hedge_engine', 'lasso')
 
     # request for inputs and prompt feedback messages to different cases
     input_status = True
@@ -56,6 +58,9 @@ if __name__ == '__main__':
             print('-- The input format is incorrect. Please re-specify.')
     input_date_df = data_wrangling.date_identification(input_date_str)
 
+    # set up the per-stage time budgets if the run has a deadline
+    deadline = deadline_setup()
+
     # create the data path if it does not exist
     if not os.path.exists(join(data_path, input_date_str)):
         os.makedirs(join(data_path, input_date_str))
@@ -64,62 +69,82 @@ if __name__ == '__main__':
     if not os.path.exists(join(output_path, input_date_str)):
         os.makedirs(join(output_path, input_date_str))
 
-    # download data and do wrangling
-    merged_df = data_wrangling.data_wrangling(input_date_df)
-
-    # split for training set, validation set, and testing set
-    training_df, testing_df = data_wrangling.training_testing_split(merged_df)
-
-    # rebalance if the input date is the first business day of a month
-    if rebalance_status:
-        portfolio_allocation_list = model.lASSO_training(input_date_str, training_df)
-    else:
-        try:
-            with open(join(output_path, 'LASSO_coef.txt'), 'r') as f:
-                portfolio_allocation_list = f.readlines()
-                portfolio_allocation_list = [item.replace('\n', '') for item in portfolio_allocation_list]
-                portfolio_allocation_list = list(map(float, portfolio_allocation_list))
-        except FileNotFoundError:
-            print('-- There is no saved record for portfolio. Please check in the \'output\' folder.')
-            sys.exit()
-
-    # train the model using training set, and collect the estimated parameters
-    AR_param_df, GARCH_param_df = model.model_training(input_date_str, training_df, portfolio_allocation_list)
-
-    # generate signals
-    signal_df = signal_generating_func(input_date_df, testing_df,
-                                       portfolio_allocation_list, AR_param_df, GARCH_param_df)
-
-    # compute values for stocks according to LASSO results
-    portfolio_position = float(signal_df['portfolio_position'].squeeze())
-    future_position = float(signal_df['future_position'].squeeze())
-    port_values_array = np.asarray(portfolio_allocation_list) * testing_df.iloc[:, 1:].to_numpy()
-    # this portfolio value is just the sum for all stocks assume 1 unit of future contract
-
-    # compute contract size for future
-    if initialization_status == 1:
-        spare_margin_value = (1/spare_future_margin_ratio - 1) * float(future_margin_ratio) * port_values_array.sum()
-        spare_margin_value = math.ceil(spare_margin_value * 100) / 100  # round up the value to 2 digits to deal with rounding error
-        future_size = math.floor(float(initial_capital) / ((1 + float(future_margin_ratio) + spare_margin_value) * port_values_array.sum()))
-        # initial_capital = portfolio_value + future_value * (future_margin_ratio + spare_margin_ratio)
-        # here future_value = future_size * future_contract_value = portfolio_value roughly
-        # and future_value * future_margin_ratio / (future_value * future_margin_ratio + spare_margin_value) = spare_future_margin_ratio
-    else:
-        future_size = float(config['parameters']['future_size'])
-    with open(join(output_path, input_date_str, 'future_size.txt'), 'w') as f:
-        f.write(f"-{future_size}")
-        f.close()
-
-    # transform stock values to weights
-    portfolio_position = float(signal_df['portfolio_position'].squeeze())
-    future_position = float(signal_df['future_position'].squeeze())
-    port_weights_array = port_values_array / port_values_array.sum()
-    port_weights_df = pd.DataFrame(port_weights_array * portfolio_position,
-                                   columns=testing_df.columns[1:], index=[input_date_df.input_date]).T
-    port_weights_df.to_csv(join(output_path, input_date_str, 'port_weights.csv'), index=True)
-
-    print('-- Computation finished. Check \'port_weights.csv\' and \'future_size.txt\' in the \'output\' folder for '
-          'the weight on each stock/index future.')
+    try:
+        # download data and do wrangling
+        merged_df = data_wrangling.data_wrangling(input_date_df, deadline)
+
+        # split for training set, validation set, and testing set
+        training_df, testing_df = data_wrangling.training_testing_split(merged_df)
+
+        # rebalance if the input date is the first business day of a month
+        if rebalance_status:
+            portfolio_allocation_list = model.lASSO_training(input_date_str, training_df)
+        else:
+            if isfile(join(output_path, 'LASSO_coef.csv')):
+                # match the coefficients to the stocks by ticker, stocks dropped from the data since are left out and
+                # stocks added since get no weight
+                coef_df = pd.read_csv(join(output_path, 'LASSO_coef.csv'), index_col=0)
+                portfolio_allocation_list = coef_df['coef'].reindex(training_df.columns[1:], fill_value=0).tolist()
+            else:
+                try:
+                    with open(join(output_path, 'LASSO_coef.txt'), 'r') as f:
+                        portfolio_allocation_list = f.readlines()
+                        portfolio_allocation_list = [item.replace('\n', '') for item in portfolio_allocation_list]
+                        portfolio_allocation_list = list(map(float, portfolio_allocation_list))
+                except FileNotFoundError:
+                    print('-- There is no saved record for portfolio. Please check in the \'output\' folder.')
+                    sys.exit()
+                if len(portfolio_allocation_list) != training_df.shape[1] - 1:
+                    print('-- The saved portfolio does not match the stocks of the input date. Please rebalance.')
+                    sys.exit()
+
+        # train the model using training set, and collect the estimated parameters
+        if hedge_engine == 'kalman':
+            # the Kalman filter also updates the portfolio weights for the input date
+            portfolio_allocation_list, AR_param_df, GARCH_param_df = model.kalman_training(
+                input_date_str, training_df, testing_df, portfolio_allocation_list, rebalance_status)
+        else:
+            AR_param_df, GARCH_param_df = model.model_training(input_date_str, training_df,
+                                                               portfolio_allocation_list)
+
+        # generate signals
+        signal_df = signal_generating_func(input_date_df, testing_df,
+                                           portfolio_allocation_list, AR_param_df, GARCH_param_df)
+
+        # compute values for stocks according to LASSO results
+        portfolio_position = float(signal_df['portfolio_position'].squeeze())
+        future_position = float(signal_df['future_position'].squeeze())
+        port_values_array = np.asarray(portfolio_allocation_list) * testing_df.iloc[:, 1:].to_numpy()
+        # this portfolio value is just the sum for all stocks assume 1 unit of future contract
+
+        # compute contract size for future
+        if initialization_status == 1:
+            spare_margin_value = (1/spare_future_margin_ratio - 1) * float(future_margin_ratio) * \
+                port_values_array.sum()
+            spare_margin_value = math.ceil(spare_margin_value * 100) / 100  # round up the value to 2 digits to deal with rounding error
+            future_size = math.floor(float(initial_capital) / ((1 + float(future_margin_ratio) + spare_margin_value) * port_values_array.sum()))
+            # initial_capital = portfolio_value + future_value * (future_margin_ratio + spare_margin_ratio)
+            # here future_value = future_size * future_contract_value = portfolio_value roughly
+            # and future_value * future_margin_ratio / (future_value * future_margin_ratio + spare_margin_value) = spare_future_margin_ratio
+        else:
+            future_size = float(config['parameters']['future_size'])
+        with open(join(output_path, input_date_str, 'future_size.txt'), 'w') as f:
+            f.write(f"-{future_size}")
+            f.close()
+
+        # transform stock values to weights
+        portfolio_position = float(signal_df['portfolio_position'].squeeze())
+        future_position = float(signal_df['future_position'].squeeze())
+        port_weights_array = port_values_array / port_values_array.sum()
+        port_weights_df = pd.DataFrame(port_weights_array * portfolio_position,
+                                       columns=testing_df.columns[1:], index=[input_date_df.input_date]).T
+        port_weights_df.to_csv(join(output_path, input_date_str, 'port_weights.csv'), index=True)
+
+        print('-- Computation finished. Check \'port_weights.csv\' and \'future_size.txt\' in the \'output\' folder '
+              'for the weight on each stock/index future.')
+    finally:
+        # report the stale or dropped data used to meet the deadline, also when the run is aborted
+        degradation_report(deadline, input_date_str)
 
     # write the inputted data and computed parameters back to the configuration file
     if initialization_status == 1: